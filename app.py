@@ -1,13 +1,22 @@
-import base64
-import requests
+import pybase64
+import httpx
+import aioboto3
+import anyio
+import asyncio
 import io
+import orjson
 import os
+import sys
 import logging
+from aiocache import Cache
+from blake3 import blake3
+from contextlib import AsyncExitStack, asynccontextmanager
+from tenacity import retry, retry_if_result, stop_after_attempt, wait_exponential
 from PIL import Image
 from dotenv import load_dotenv
 from fastapi import FastAPI, File, UploadFile, Form, Request, HTTPException
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, Response
 
 # --- Configuration & Setup ---
 
@@ -16,21 +25,204 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Keep one pooled connection to Groq alive across requests and close it on shutdown."""
+    # Make sure the 'templates' directory exists for Jinja2
+    os.makedirs('templates', exist_ok=True)
+    # Full image decodes are CPU-bound, so run at most one per core off the event loop
+    app.state.verify_limiter = anyio.CapacityLimiter(os.cpu_count() or 1)
+    async with AsyncExitStack() as stack:
+        app.state.http = await stack.enter_async_context(httpx.AsyncClient(
+            base_url=GROQ_BASE_URL,
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=200, max_connections=1000),
+            timeout=httpx.Timeout(30.0, connect=5.0)
+        ))
+        # Object storage client, only when an image bucket is configured
+        app.state.s3 = None
+        if IMAGE_BUCKET:
+            app.state.s3 = await stack.enter_async_context(
+                aioboto3.Session().client("s3", endpoint_url=S3_ENDPOINT_URL)
+            )
+        yield
+
+app = FastAPI(lifespan=lifespan)
 
 # IMPORTANT: Jinja2Templates requires a directory named 'templates'
 templates = Jinja2Templates(directory="templates")
 
-GROQ_API_URL = "https://api.groq.com/openai/v1/chat/completions"
+GROQ_BASE_URL = "https://api.groq.com"
+GROQ_CHAT_PATH = "/openai/v1/chat/completions"
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 
 # Set the currently supported Groq Vision model (FIXED MODEL NAME)
-VISION_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct" 
+VISION_MODEL = sys.intern("meta-llama/llama-4-scout-17b-16e-instruct")
+
+# Serialized '{"<model>":' prefix of every successful response, so only the answer is encoded per request
+RESPONSE_PREFIX = orjson.dumps({VISION_MODEL: ""})[:-3]
+
+# Fixed system prompt sent first on every call, so the provider's prompt caching can reuse the shared prefix
+SYSTEM_PROMPT = (
+    "You are a medical vision assistant. Describe what is visible in the image precisely, "
+    "answer the user's question about it, and note when findings should be confirmed by a clinician."
+)
+
+# Upload limits: files are read in 1 MB chunks and rejected past 20 MB
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+UPLOAD_CHUNK_BYTES = 1 << 20
+
+# Raw bytes base64-encoded per step (a multiple of 3 so chunks concatenate cleanly)
+B64_CHUNK_BYTES = 48 * 1024
+# Placeholder image URL, replaced by the encoded image when building an inline request body
+IMAGE_URL_SLOT = "__IMAGE_URL__"
+
+# Set DEEP_IMAGE_VALIDATION=1 to also fully decode uploads with PIL after the magic-byte check
+DEEP_IMAGE_VALIDATION = os.getenv("DEEP_IMAGE_VALIDATION", "0") == "1"
+
+# Optional object storage (S3 or compatible, e.g. R2): when IMAGE_BUCKET is set, images are sent
+# to Groq as presigned URLs instead of base64 data URIs
+IMAGE_BUCKET = os.getenv("IMAGE_BUCKET")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+IMAGE_URL_TTL = 3600
+
+# Answer cache keyed by BLAKE3 hashes of (image, query); in-process by default, e.g. CACHE_URL=redis://localhost:6379 to share it
+ANSWER_CACHE_TTL = 3600
+answer_cache = Cache.from_url(os.getenv("CACHE_URL", "memory://"))
+
+# Groq calls currently in progress, by answer cache key, so identical concurrent requests share one call
+inflight: dict[str, asyncio.Future] = {}
 
 if not GROQ_API_KEY:
     # This will prevent the server from starting if the API key is missing
     raise ValueError("GROQ_API_KEY is not set in the .env file")
 
+# Request pieces that never change, built once instead of per call
+GROQ_HEADERS = {
+    "Authorization": f"Bearer {GROQ_API_KEY}",
+    "Content-Type": "application/json"
+}
+BASE_PAYLOAD = {"model": VISION_MODEL, "max_tokens": 1000}
+
+# --- Helpers ---
+
+def sniff_mime(b: bytes) -> str | None:
+    """Return the image MIME type from the file's magic bytes, or None if unrecognised."""
+    if b.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if b.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if b[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if b[:4] == b"RIFF" and b[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+def answer_response(answer: str) -> Response:
+    """JSON response of the form {VISION_MODEL: answer}."""
+    return Response(content=RESPONSE_PREFIX + orjson.dumps(answer) + b"}", media_type="application/json")
+
+def verify_image(image_content: bytes) -> None:
+    """Fully parse the image with PIL, raising if it is corrupt."""
+    with Image.open(io.BytesIO(image_content)) as img:
+        img.verify()
+
+async def cache_get(key: str):
+    """Read from the answer cache, treating a cache outage as a miss."""
+    try:
+        return await answer_cache.get(key)
+    except Exception as e:
+        logger.error(f"Cache read failed, treating as a miss: {str(e)}")
+        return None
+
+async def cache_set(key: str, value, ttl: int) -> None:
+    """Write to the answer cache on a best-effort basis; failures are only logged."""
+    try:
+        await answer_cache.set(key, value, ttl=ttl)
+    except Exception as e:
+        logger.error(f"Cache write failed: {str(e)}")
+
+def answer_cache_key(image_hash: str, query: str) -> str:
+    """Exact-match cache key for an image/query pair (128-bit BLAKE3 of each)."""
+    return image_hash + blake3(query.encode("utf-8")).hexdigest(16)
+
+async def upload_image(s3, image_content: bytes, mime: str, image_hash: str) -> str:
+    """Store the image in IMAGE_BUCKET (once per content hash) and return a presigned GET URL."""
+    url_key = f"image_url:{image_hash}"
+    if (url := await cache_get(url_key)) is not None:
+        return url
+    object_key = f"uploads/{image_hash}"
+    await s3.put_object(Bucket=IMAGE_BUCKET, Key=object_key, Body=image_content, ContentType=mime)
+    url = await s3.generate_presigned_url(
+        "get_object", Params={"Bucket": IMAGE_BUCKET, "Key": object_key}, ExpiresIn=IMAGE_URL_TTL
+    )
+    # Expire the cached URL well before the signature does
+    await cache_set(url_key, url, IMAGE_URL_TTL // 2)
+    return url
+
+@retry(
+    retry=retry_if_result(lambda response: response.status_code == 429),
+    wait=wait_exponential(multiplier=0.5, max=8),
+    stop=stop_after_attempt(4),
+    retry_error_callback=lambda state: state.outcome.result()
+)
+async def post_to_groq(http: httpx.AsyncClient, content: bytes, headers: dict) -> httpx.Response:
+    """POST a chat completion to Groq, backing off exponentially while rate-limited (429)."""
+    return await http.post(GROQ_CHAT_PATH, content=content, headers=headers)
+
+def build_body(query: str, image_url: str) -> bytes:
+    """Serialize the chat completion request for a query about the image at image_url."""
+    # 3. Construct API Messages
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": query},
+                {"type": "image_url", "image_url": {"url": image_url}}
+            ]
+        }
+    ]
+    return orjson.dumps({**BASE_PAYLOAD, "messages": messages})
+
+def build_inline_body(query: str, image_content: bytes, mime: str) -> bytes:
+    """
+    Serialize the request with the image inlined as a base64 data URI, encoding it
+    48 KB at a time straight into one buffer sized for the whole body.
+    """
+    # The image URL is the last string in the body, so the final slot marker is ours even if the query contains one
+    head, tail = build_body(query, IMAGE_URL_SLOT).rsplit(IMAGE_URL_SLOT.encode("ascii"), 1)
+    # Base64 and the data URI prefix need no JSON escaping
+    head += f"data:{mime};base64,".encode("ascii")
+    out = bytearray(len(head) + ((len(image_content) + 2) // 3) * 4 + len(tail))
+    out[:len(head)] = head
+    pos = len(head)
+    view = memoryview(image_content)
+    # Chunk size is a multiple of 3, so only the final chunk can produce padding
+    for i in range(0, len(view), B64_CHUNK_BYTES):
+        encoded = pybase64.b64encode(view[i:i + B64_CHUNK_BYTES])
+        out[pos:pos + len(encoded)] = encoded
+        pos += len(encoded)
+    out[pos:] = tail
+    return bytes(out)
+
+async def ask_groq(http: httpx.AsyncClient, body: bytes) -> str:
+    """Send a serialized chat completion request to the Groq Vision API and return the answer text."""
+    # 4. Make API Request (awaited, so the event loop keeps serving other users)
+    response = await post_to_groq(http, body, GROQ_HEADERS)
+
+    # 5. Process Groq API Response
+    if response.status_code == 200:
+        result = orjson.loads(response.content)
+        answer = result["choices"][0]["message"]["content"]
+        logger.info(f"Processed response successfully from {VISION_MODEL}")
+        return answer
+    else:
+        # Handle Groq API errors (like 400 or 404)
+        error_detail = orjson.loads(response.content).get("error", {}).get("message", "Unknown Groq API Error")
+        logger.error(f"Groq API Error {response.status_code}: {error_detail}")
+        raise HTTPException(status_code=response.status_code, detail=f"Groq API Error: {error_detail}")
+
 # --- Routes ---
 
 @app.get("/", response_class=HTMLResponse)
@@ -39,72 +231,90 @@ async def read_root(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 @app.post("/upload_and_query")
-async def upload_and_query(image: UploadFile = File(...), query: str = Form(...)):
+async def upload_and_query(request: Request, image: UploadFile = File(...), query: str = Form(...)):
     """Process uploaded image and query using Groq Vision API."""
     
     logger.info(f"Received query: {query}")
     
     try:
-        # 1. Read and Encode Image
-        image_content = await image.read()
+        # 1. Read Image (in bounded chunks, so an oversize upload is rejected before it is fully buffered)
+        buf = bytearray()
+        while chunk := await image.read(UPLOAD_CHUNK_BYTES):
+            buf.extend(chunk)
+            if len(buf) > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail="File too large (max 20 MB).")
+        image_content = bytes(buf)
+        del buf
         if not image_content:
             raise HTTPException(status_code=400, detail="Empty file uploaded.")
         
-        # Base64 encode the image
-        encoded_image = base64.b64encode(image_content).decode("utf-8")
+        # 2. Image Validation (magic-byte sniffing, no full decode)
+        mime = sniff_mime(image_content[:16])
+        if mime is None:
+            logger.error("Invalid image format: unrecognised file signature")
+            raise HTTPException(status_code=400, detail="Invalid image format: expected JPEG, PNG, GIF or WEBP.")
+        if DEEP_IMAGE_VALIDATION:
+            try:
+                await anyio.to_thread.run_sync(verify_image, image_content, limiter=request.app.state.verify_limiter)
+            except Exception as e:
+                logger.error(f"Invalid image format: {str(e)}")
+                raise HTTPException(status_code=400, detail=f"Invalid image format: {str(e)}")
+
+        # Serve repeated image/query pairs from the cache without calling Groq
+        image_hash = blake3(image_content).hexdigest(16)
+        cache_key = answer_cache_key(image_hash, query)
+        if (cached := await cache_get(cache_key)) is not None:
+            logger.info(f"Served cached response from {VISION_MODEL}")
+            return answer_response(cached)
+
+        # An identical request is already calling Groq: wait for its answer instead of calling again
+        while (pending := inflight.get(cache_key)) is not None:
+            try:
+                answer = await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    raise
+                # Only the request we were waiting on was cancelled; try again, making the call ourselves if needed
+                logger.info("Coalesced request was cancelled, retrying")
+                continue
+            logger.info(f"Served coalesced response from {VISION_MODEL}")
+            return answer_response(answer)
+        inflight[cache_key] = future = asyncio.get_running_loop().create_future()
 
-        # 2. Image Validation
         try:
-            img = Image.open(io.BytesIO(image_content))
-            img.verify()
+            # Prefer a presigned object-storage URL; fall back to a base64 data URI
+            body = None
+            if request.app.state.s3 is not None:
+                try:
+                    body = build_body(query, await upload_image(request.app.state.s3, image_content, mime, image_hash))
+                except Exception as e:
+                    logger.error(f"Image upload failed, sending base64 instead: {str(e)}")
+            if body is None:
+                body = build_inline_body(query, image_content, mime)
+            # Drop the raw bytes before the Groq call
+            del image_content
+
+            answer = await ask_groq(request.app.state.http, body)
+            future.set_result(answer)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
         except Exception as e:
-            logger.error(f"Invalid image format: {str(e)}")
-            raise HTTPException(status_code=400, detail=f"Invalid image format: {str(e)}")
-
-        # 3. Construct API Messages (using the Base64 data URI)
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": query},
-                    # Note: Using image/jpeg as the generic mime type for simplicity
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encoded_image}"}}
-                ]
-            }
-        ]
-
-        # 4. Make API Request
-        response = requests.post(
-            GROQ_API_URL,
-            json={
-                "model": VISION_MODEL, # ONLY calling the supported model
-                "messages": messages,
-                "max_tokens": 1000
-            },
-            headers={
-                "Authorization": f"Bearer {GROQ_API_KEY}",
-                "Content-Type": "application/json"
-            },
-            timeout=30
-        )
-
-        # 5. Process Groq API Response
-        if response.status_code == 200:
-            result = response.json()
-            answer = result["choices"][0]["message"]["content"]
-            logger.info(f"Processed response successfully from {VISION_MODEL}")
-            
-            # Return a dictionary with the model name as the key (e.g., {"meta-llama/...": "Answer"})
-            return JSONResponse(status_code=200, content={VISION_MODEL: answer})
-        else:
-            # Handle Groq API errors (like 400 or 404)
-            error_detail = response.json().get("error", {}).get("message", "Unknown Groq API Error")
-            logger.error(f"Groq API Error {response.status_code}: {error_detail}")
-            raise HTTPException(status_code=response.status_code, detail=f"Groq API Error: {error_detail}")
-
-    except HTTPException as he:
-        # Pass through expected HTTP errors (400, 404, etc.)
-        raise he
+            # Waiting duplicates get the same error; mark it retrieved in case there are none
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            del inflight[cache_key]
+
+        await cache_set(cache_key, answer, ANSWER_CACHE_TTL)
+
+        # Return a dictionary with the model name as the key (e.g., {"meta-llama/...": "Answer"})
+        return answer_response(answer)
+
+    except HTTPException:
+        # Pass through expected HTTP errors (400, 404, etc.) unchanged; only unknown errors become 500s
+        raise
     except Exception as e:
         logger.error(f"An unexpected server error occurred: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
@@ -112,6 +322,13 @@ async def upload_and_query(image: UploadFile = File(...), query: str = Form(...)
 # --- Execution Block ---
 if __name__ == "__main__":
     import uvicorn
-    # Make sure the 'templates' directory exists for Jinja2
-    os.makedirs('templates', exist_ok=True)
-    uvicorn.run(app, host="127.0.0.1", port=8000)
+    # Multiple workers need an import string; uvloop/httptools replace the default loop and HTTP parser
+    uvicorn.run(
+        "app:app",
+        host="127.0.0.1",
+        port=8000,
+        workers=max(2, os.cpu_count() or 1),
+        loop="uvloop",
+        http="httptools",
+        log_level="info"
+    )
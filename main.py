@@ -1,9 +1,9 @@
-import base64
+import pybase64
 import requests
-import io
+import orjson
 import os
 import logging
-from PIL import Image
+from pathlib import Path
 from dotenv import load_dotenv
 
 # --- Configuration ---
@@ -24,9 +24,55 @@ GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 # We are using the currently available, powerful Groq Vision model.
 VISION_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct"
 
+# System prompt sent before every query (kept identical to app.py)
+SYSTEM_PROMPT = (
+    "You are a medical vision assistant. Describe what is visible in the image precisely, "
+    "answer the user's question about it, and note when findings should be confirmed by a clinician."
+)
+
 if not GROQ_API_KEY:
     raise ValueError("GROQ API KEY is not set in the .env file")
 
+# Request pieces that never change, built once instead of per call
+GROQ_HEADERS = {
+    "Authorization": f"Bearer {GROQ_API_KEY}",
+    "Content-Type": "application/json"
+}
+BASE_PAYLOAD = {"model": VISION_MODEL, "max_tokens": 1000}
+
+# Raw bytes base64-encoded per step (a multiple of 3 so chunks concatenate cleanly)
+B64_CHUNK_BYTES = 48 * 1024
+
+# Reuse one keep-alive connection to Groq across calls
+session = requests.Session()
+
+# --- Helpers ---
+def sniff_mime(b: bytes) -> str | None:
+    """Return the image MIME type from the file's magic bytes, or None if unrecognised."""
+    if b.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if b.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if b[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if b[:4] == b"RIFF" and b[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+def encode_data_uri(image_content: bytes, mime: str) -> str:
+    """Base64-encode the image into a data URI, 48 KB at a time into one preallocated buffer."""
+    prefix = f"data:{mime};base64,".encode("ascii")
+    out = bytearray(len(prefix) + ((len(image_content) + 2) // 3) * 4)
+    out[:len(prefix)] = prefix
+    pos = len(prefix)
+    view = memoryview(image_content)
+    # Chunk size is a multiple of 3, so only the final chunk can produce padding
+    for i in range(0, len(view), B64_CHUNK_BYTES):
+        encoded = pybase64.b64encode(view[i:i + B64_CHUNK_BYTES])
+        out[pos:pos + len(encoded)] = encoded
+        pos += len(encoded)
+    return out.decode("ascii")
+
 # --- Function to Process Image and Query ---
 def process_image(image_path, query):
     """
@@ -35,50 +81,44 @@ def process_image(image_path, query):
     """
     try:
         # 1. Read and Encode Image
-        with open(image_path, "rb") as image_file:
-            image_content = image_file.read()
-            # Base64 encode the image for the API call
-            encoded_image = base64.b64encode(image_content).decode("utf-8")
+        image_content = Path(image_path).read_bytes()
         
-        # 2. Basic Image Validation (using PIL)
-        try:
-            img = Image.open(io.BytesIO(image_content))
-            img.verify()  # Verifies image integrity
-        except Exception as e:
-            logger.error(f"Invalid image format: {str(e)}")
-            return {"error": f"Invalid image format: {str(e)}"}
+        # 2. Basic Image Validation (magic-byte sniffing, no full decode)
+        mime = sniff_mime(image_content[:16])
+        if mime is None:
+            logger.error("Invalid image format: unrecognised file signature")
+            return {"error": "Invalid image format: expected JPEG, PNG, GIF or WEBP."}
+
+        # Base64 encode the image into its data URI, then drop the raw bytes
+        data_uri = encode_data_uri(image_content, mime)
+        del image_content
         
         # 3. Construct API Messages
         messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
             {
                 "role": "user",
                 "content": [
                     {"type": "text", "text": query},
                     # The image is embedded directly into the content with a base64 data URI
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encoded_image}"}}
+                    {"type": "image_url", "image_url": {"url": data_uri}}
                 ]
             }
         ]
 
         # 4. Make API Request
         try:
-            response = requests.post(
+            payload = {**BASE_PAYLOAD, "messages": messages}
+            response = session.post(
                 GROQ_API_URL, 
-                json={
-                    "model": VISION_MODEL, 
-                    "messages": messages, 
-                    "max_tokens": 1000
-                },
-                headers = {
-                    "Authorization": f"Bearer {GROQ_API_KEY}",
-                    "Content-Type": "application/json"
-                },
+                data=orjson.dumps(payload),
+                headers=GROQ_HEADERS,
                 timeout = 30
             )
             
             # 5. Process Response
             if response.status_code == 200:
-                result = response.json()
+                result = orjson.loads(response.content)
                 answer = result["choices"][0]["message"]["content"]
                 logger.info(f"Processed response from {VISION_MODEL} API : {answer[:100]}...")
                 return {VISION_MODEL: answer}